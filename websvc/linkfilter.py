@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import math
+import select
+import threading
+import time
+
+
+class LinkFilter():
+    """
+    Bloom filter over the links of every event in the database.
+
+    A negative answer from might_contain() is definite, so GETs for
+    links that were never created can be turned away without a
+    database query. A positive answer may be a false positive and
+    still has to be checked against the database.
+
+    Until a rebuild has completed, the filter knows nothing and
+    might_contain() answers True for every link. invalidate() puts it
+    back in that state. Use it when links may have been missed, for
+    example while the LinkListener is disconnected.
+
+    Bloom filters cannot forget entries, so links of deleted events
+    linger until the next rebuild. Callers are expected to check
+    is_stale() and rebuild periodically.
+    """
+
+    def __init__(self, capacity=1000000, error_rate=0.01, max_age=3600,
+                 retry_interval=10):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.max_age = max_age
+        self.retry_interval = retry_interval
+        self.lock = threading.Lock()
+        # held from begin_rebuild() until the rebuild ends
+        self._rebuild_lock = threading.Lock()
+        # links added while a rebuild is scanning the table
+        self._added_during_rebuild = None
+        # bumped by invalidate(), a rebuild that began before
+        # an invalidate() does not make the filter ready
+        self._epoch = 0
+        self._rebuild_epoch = None
+        self.ready = False
+        self.attempted_at = 0
+        self._reset(capacity)
+
+    def _reset(self, capacity):
+        """
+        Size the bit array for the given capacity and the configured
+        error rate, and clear it.
+        """
+        # standard sizing: m = -n ln(p) / ln(2)^2 and k = m/n ln(2)
+        capacity = max(capacity, 1)
+        num_bits = int(math.ceil(-capacity * math.log(self.error_rate)
+                                 / (math.log(2) ** 2)))
+        self.num_bits = max(num_bits, 8)
+        self.num_hashes = max(int(round(self.num_bits / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+        self.built_at = time.time()
+
+    def _positions(self, link):
+        """
+        Yield the bit positions for a link using double hashing
+        over a single md5 digest.
+        """
+        digest = hashlib.md5(link.encode('utf-8')).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, link):
+        """
+        Record that an event with this link exists. Adding a link
+        that is already in the filter doesn't change the count.
+        """
+        with self.lock:
+            added = False
+            for pos in self._positions(link):
+                mask = 1 << (pos & 7)
+                if not self.bits[pos >> 3] & mask:
+                    self.bits[pos >> 3] |= mask
+                    added = True
+            if added:
+                self.count += 1
+            if self._added_during_rebuild is not None:
+                self._added_during_rebuild.append(link)
+
+    def might_contain(self, link):
+        """
+        Return False if the link definitely does not exist.
+        Return True if it might, or if the filter is not ready.
+        """
+        with self.lock:
+            if not self.ready:
+                return True
+            for pos in self._positions(link):
+                if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                    return False
+            return True
+
+    def invalidate(self):
+        """
+        Stop trusting the filter until the next rebuild that
+        begins after this call.
+        """
+        with self.lock:
+            self.ready = False
+            self._epoch += 1
+
+    def begin_rebuild(self):
+        """
+        Start recording added links for a rebuild. Call this before
+        running the query that the links for end_rebuild() come from,
+        so that links added between the query's snapshot and the end
+        of the rebuild are not lost. Blocks while another rebuild is
+        in progress.
+        """
+        self._rebuild_lock.acquire()
+        with self.lock:
+            self._added_during_rebuild = []
+            self._rebuild_epoch = self._epoch
+            self.attempted_at = time.time()
+
+    def cancel_rebuild(self):
+        """
+        Give up on a rebuild started with begin_rebuild().
+        Does nothing if no rebuild is in progress.
+        """
+        with self.lock:
+            if self._added_during_rebuild is None:
+                return
+            self._added_during_rebuild = None
+        self._rebuild_lock.release()
+
+    def end_rebuild(self, links, expected_count=None):
+        """
+        Repopulate the filter from an iterable of links and finish a
+        rebuild started with begin_rebuild(). The iterable is consumed
+        one link at a time so a streaming query can be passed in
+        without loading the whole table into memory. If it raises,
+        the rebuild is cancelled and the exception passed on.
+        """
+        capacity = self.capacity
+        if expected_count is not None:
+            # leave room for events created before the next rebuild
+            capacity = max(capacity, expected_count * 2)
+
+        fresh = LinkFilter(capacity, self.error_rate, self.max_age)
+        try:
+            for link in links:
+                fresh.add(link)
+        except Exception:
+            self.cancel_rebuild()
+            raise
+
+        # swap in the new bit array in one go so that readers
+        # never see a half built filter
+        with self.lock:
+            for link in self._added_during_rebuild:
+                fresh.add(link)
+            self._added_during_rebuild = None
+            self.num_bits = fresh.num_bits
+            self.num_hashes = fresh.num_hashes
+            self.bits = fresh.bits
+            self.count = fresh.count
+            self.built_at = time.time()
+            self.ready = self._rebuild_epoch == self._epoch
+        self._rebuild_lock.release()
+
+    def rebuild(self, links, expected_count=None):
+        """ Repopulate the filter from an iterable of links. """
+        self.begin_rebuild()
+        self.end_rebuild(links, expected_count)
+
+    def is_stale(self):
+        """
+        Return True if the filter is older than max_age seconds, or
+        it is not ready and the last attempt to build it was more than
+        retry_interval seconds ago.
+        """
+        if not self.ready:
+            return time.time() - self.attempted_at > self.retry_interval
+        return time.time() - self.built_at > self.max_age
+
+    def false_positive_rate(self):
+        """
+        Return the expected false positive rate given the number of
+        links added so far: (1 - e^(-kn/m))^k
+        """
+        return (1 - math.exp(-self.num_hashes * self.count
+                             / self.num_bits)) ** self.num_hashes
+
+    def memory_usage(self):
+        """ Return the size of the bit array in bytes. """
+        return len(self.bits)
+
+    def stats(self):
+        """ Return a dictionary describing the current state of the filter. """
+        return {'count': self.count,
+                'num_bits': self.num_bits,
+                'num_hashes': self.num_hashes,
+                'memory_bytes': self.memory_usage(),
+                'false_positive_rate': self.false_positive_rate()}
+
+
+class LinkListener():
+    """
+    Adds the links of events created by other processes to a
+    LinkFilter. An AFTER INSERT trigger on events sends each new link
+    on the event_links channel, see models.py, and this listens for
+    them on a dedicated connection.
+
+    on_connect is called after every (re)connect, once LISTEN is in
+    place, and should rebuild the filter. Links created while the
+    listener was down are only recovered by that rebuild, so the
+    filter is invalidated whenever the connection is lost.
+    """
+
+    CHANNEL = 'event_links'
+
+    def __init__(self, engine, link_filter, on_connect, on_error=None,
+                 retry_interval=5):
+        self.engine = engine
+        self.link_filter = link_filter
+        self.on_connect = on_connect
+        self.on_error = on_error
+        self.retry_interval = retry_interval
+        self.lock = threading.Lock()
+        self.conn = None
+
+    @property
+    def connected(self):
+        """ True while the listening connection is open. """
+        return self.conn is not None
+
+    def connect(self):
+        """ Open the listening connection and LISTEN on the channel. """
+        # detached from the pool, this connection is never given back
+        fairy = self.engine.raw_connection()
+        fairy.detach()
+        conn = fairy.connection
+        conn.autocommit = True
+        cursor = conn.cursor()
+        cursor.execute("LISTEN %s" % self.CHANNEL)
+        cursor.close()
+        with self.lock:
+            self.conn = conn
+
+    def close(self):
+        """ Close the listening connection. """
+        with self.lock:
+            conn, self.conn = self.conn, None
+        if conn is not None:
+            conn.close()
+
+    def poll(self, blocking=True):
+        """
+        Add the links of any notifications that have arrived.
+        Does not wait for new ones. Without blocking, returns False
+        straight away if another thread is polling.
+        Raises the driver's error if the connection is lost.
+        """
+        if not self.lock.acquire(blocking):
+            return False
+        try:
+            if self.conn is not None:
+                self.conn.poll()
+                while self.conn.notifies:
+                    self.link_filter.add(self.conn.notifies.pop(0).payload)
+            return True
+        finally:
+            self.lock.release()
+
+    def run(self):
+        """ Listen for new links until the process exits. """
+        while True:
+            try:
+                self.link_filter.invalidate()
+                self.connect()
+                self.on_connect()
+                while True:
+                    select.select([self.conn], [], [], self.retry_interval)
+                    self.poll()
+            except Exception as error:
+                self.link_filter.invalidate()
+                if self.on_error is not None:
+                    self.on_error(error)
+                try:
+                    self.close()
+                except Exception:
+                    pass
+                time.sleep(self.retry_interval)
+
+    def start(self):
+        """ Run the listener in a daemon thread. """
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
@@ -1,10 +1,21 @@
 # -*- coding: utf-8 -*-
+import datetime as dt
+import math
 import uuid
 
 #from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, \
+                       ForeignKey, Index, UniqueConstraint, DDL, event, \
+                       select, bindparam
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import deferred
 from database import Base
 
+# supported recurrence rules and the time between
+# two occurrences for an interval of 1
+RECURRENCE_STEPS = {'DAILY': dt.timedelta(days=1),
+                    'WEEKLY': dt.timedelta(weeks=1)}
+
 class Event(Base):
     __tablename__ = "events"
     id = Column(Integer, primary_key=True)
@@ -14,8 +25,17 @@ class Event(Base):
     description = Column(String())
     link = Column(String(64), unique=True)
     access = Column(String(256))
+    # columns from here on were added later, existing databases
+    # get them by hand, see "Upgrading an existing database" in README.md
+    recurrence = Column(String(16))
+    recurrence_interval = Column(Integer)
+    recurrence_until = Column(DateTime())
+    # full text search document over name and description,
+    # kept up to date by the events_search_vector_update trigger
+    search_vector = deferred(Column(TSVECTOR))
 
-    def __init__(self, name=None, datetime=None, tz_offset=None, description=None, access=None):
+    def __init__(self, name=None, datetime=None, tz_offset=None, description=None, access=None,
+                 recurrence=None, recurrence_interval=1, recurrence_until=None):
         if name is None:
             raise ValueError("Event name must be provided.")
         if datetime is None:
@@ -24,6 +44,10 @@ class Event(Base):
             raise ValueError("Timezone offset must be provided.")
         if access is None:
             pass
+        if recurrence is not None and recurrence not in RECURRENCE_STEPS:
+            raise ValueError("Recurrence must be one of %s." % ", ".join(sorted(RECURRENCE_STEPS)))
+        if recurrence is not None and recurrence_interval < 1:
+            raise ValueError("Recurrence interval must be at least 1.")
 
         self.name = name
         self.datetime = datetime
@@ -31,6 +55,9 @@ class Event(Base):
         self.description = description
         self.link = self.create_link()
         self.access = access
+        self.recurrence = recurrence
+        self.recurrence_interval = recurrence_interval
+        self.recurrence_until = recurrence_until
 
 
     def create_link(self):
@@ -48,3 +75,150 @@ class Event(Base):
         # get over a million events in the db.
         link = uuid.uuid4().hex[8:14]
         return link
+
+    def is_occurrence(self, start):
+        """
+        Return True if an occurrence of this event
+        starts at the given datetime.
+        """
+        return any(True for _ in self.occurrences(start, start + dt.timedelta(seconds=1)))
+
+    def occurrences(self, window_start, window_end, overrides=None):
+        """
+        Generate the occurrences of this event that start in
+        [window_start, window_end), in the event's own timezone
+        offset like Event.datetime.
+        Yields (occurrence_start, override) pairs, where override is
+        the OccurrenceOverride for that occurrence or None.
+        Cancelled occurrences are skipped.
+        :param overrides: dictionary of OccurrenceOverride objects
+                          keyed by the occurrence they replace
+        """
+        if overrides is None:
+            overrides = {}
+
+        if self.recurrence is None:
+            if window_start <= self.datetime < window_end:
+                candidates = iter([self.datetime])
+            else:
+                candidates = iter([])
+        else:
+            candidates = self._series(window_start, window_end)
+
+        for start in candidates:
+            override = overrides.get(start)
+            if override is not None and override.cancelled:
+                continue
+            yield (start, override)
+
+    def _series(self, window_start, window_end):
+        """
+        Generate the start of each occurrence of a recurring event
+        in [window_start, window_end) without walking the series
+        from its first occurrence.
+        """
+        step = RECURRENCE_STEPS[self.recurrence] * self.recurrence_interval
+        # index of the first occurrence at or after window_start
+        index = 0
+        if window_start > self.datetime:
+            index = int(math.ceil((window_start - self.datetime) / step))
+
+        start = self.datetime + index * step
+        while start < window_end:
+            if self.recurrence_until is not None and start > self.recurrence_until:
+                return
+            yield start
+            start += step
+
+
+class EventView():
+    """
+    Read only record of the columns needed to show an event.
+    Loaded with EVENT_VIEW_STATEMENT instead of the ORM, so the
+    access hash is never fetched and nothing goes through the session.
+    """
+    __slots__ = ('name', 'description', 'datetime', 'tz_offset', 'recurrence', 'link')
+
+    def __init__(self, name, description, datetime, tz_offset, recurrence, link):
+        self.name = name
+        self.description = description
+        self.datetime = datetime
+        self.tz_offset = tz_offset
+        self.recurrence = recurrence
+        self.link = link
+
+
+EVENT_VIEW_STATEMENT = select([Event.__table__.c.name,
+                               Event.__table__.c.description,
+                               Event.__table__.c.datetime,
+                               Event.__table__.c.tz_offset,
+                               Event.__table__.c.recurrence,
+                               Event.__table__.c.link]) \
+                        .where(Event.__table__.c.link == bindparam('link')) \
+                        .limit(1)
+
+
+class OccurrenceOverride(Base):
+    """
+    Change to or cancellation of a single occurrence of a recurring
+    event. Only occurrences that differ from the series are stored.
+    """
+    __tablename__ = "occurrence_overrides"
+    __table_args__ = (UniqueConstraint('event_id', 'occurrence'),)
+    id = Column(Integer, primary_key=True)
+    event_id = Column(Integer, ForeignKey('events.id', ondelete='CASCADE'), nullable=False)
+    # start of the occurrence being overridden, as generated by the series
+    occurrence = Column(DateTime(), nullable=False)
+    cancelled = Column(Boolean, default=False, nullable=False)
+    name = Column(String(64))
+    description = Column(String())
+    datetime = Column(DateTime())
+    tz_offset = Column(Integer)
+
+    def __init__(self, event_id=None, occurrence=None):
+        if event_id is None:
+            raise ValueError("Event id must be provided.")
+        if occurrence is None:
+            raise ValueError("Occurrence must be provided.")
+
+        self.event_id = event_id
+        self.occurrence = occurrence
+        self.cancelled = False
+
+
+
+class RsvpCount(Base):
+    """
+    Number of RSVPs for an event. Written in batches by
+    RsvpCounter, see rsvp.py.
+    """
+    __tablename__ = "rsvp_counts"
+    link = Column(String(64), ForeignKey('events.link', ondelete='CASCADE'), primary_key=True)
+    count = Column(Integer, default=0, nullable=False)
+
+
+Index('ix_events_search', Event.search_vector, postgresql_using='gin')
+
+event.listen(Event.__table__, 'after_create', DDL("""
+    CREATE TRIGGER events_search_vector_update
+    BEFORE INSERT OR UPDATE OF name, description ON events
+    FOR EACH ROW EXECUTE PROCEDURE
+    tsvector_update_trigger(search_vector, 'pg_catalog.english', name, description)
+"""))
+
+# tell every process about new links so they can add them
+# to their link filter, see LinkListener in linkfilter.py
+event.listen(Event.__table__, 'after_create', DDL("""
+    CREATE OR REPLACE FUNCTION notify_event_link() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('event_links', NEW.link);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+"""))
+
+event.listen(Event.__table__, 'after_create', DDL("""
+    CREATE TRIGGER events_link_notify
+    AFTER INSERT OR UPDATE OF link ON events
+    FOR EACH ROW EXECUTE PROCEDURE notify_event_link()
+"""))
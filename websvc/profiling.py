@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+
+from sqlalchemy import event
+
+
+class QueryProfiler():
+    """
+    Counts and times the SQL statements an engine executes.
+
+    Statements are counted per request between start_request() and
+    end_request(), which are called from the thread handling the
+    request. Statements slower than slow_threshold seconds are logged
+    to the slow query logger along with their plan. SELECTs get
+    EXPLAIN ANALYZE, which runs the statement a second time. Other
+    statements get a plain EXPLAIN. Statements that fail, e.g. when
+    cancelled by statement_timeout, are counted and logged too, but
+    not explained.
+    """
+
+    def __init__(self, slow_threshold=0.1, explain=True, logger=None):
+        self.slow_threshold = slow_threshold
+        self.explain = explain
+        self.logger = logger or logging.getLogger('skedjit.slowquery')
+        self.local = threading.local()
+
+    def install(self, engine):
+        """ Start profiling the statements executed on an engine. """
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+        event.listen(engine, 'handle_error', self._handle_error)
+
+    def uninstall(self, engine):
+        """ Stop profiling the statements executed on an engine. """
+        event.remove(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.remove(engine, 'after_cursor_execute', self._after_cursor_execute)
+        event.remove(engine, 'handle_error', self._handle_error)
+
+    def start_request(self):
+        """ Start counting the statements executed by this thread. """
+        self.local.count = 0
+        self.local.elapsed = 0.0
+
+    def end_request(self):
+        """
+        Stop counting the statements executed by this thread.
+        :return: (number of statements, total seconds spent in them)
+        """
+        stats = (getattr(self.local, 'count', 0), getattr(self.local, 'elapsed', 0.0))
+        self.local.count = None
+        self.local.elapsed = None
+        return stats
+
+    # the start time is kept on the execution context, which lasts
+    # for one statement, whether it succeeds or fails
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters,
+                               context, executemany):
+        if context is not None:
+            context._query_profiler_start = time.time()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        elapsed = self._elapsed(context)
+        if elapsed is None:
+            return
+
+        if elapsed > self.slow_threshold:
+            plan = None
+            if self.explain and not executemany:
+                plan = self._explain(cursor, statement, parameters)
+            self.logger.warning("Slow query (%.1fms): %s\nParameters: %s\nPlan:\n%s"
+                                % (elapsed * 1000, statement, parameters, plan))
+
+    def _handle_error(self, exception_context):
+        elapsed = self._elapsed(exception_context.execution_context)
+        if elapsed is None:
+            return
+
+        # the transaction is aborted, so there is no plan to be had
+        if elapsed > self.slow_threshold:
+            self.logger.warning("Failed query (%.1fms): %s\nParameters: %s\nError: %s"
+                                % (elapsed * 1000, exception_context.statement,
+                                   exception_context.parameters,
+                                   exception_context.original_exception))
+
+    def _elapsed(self, context):
+        """
+        Return how long the statement of an execution context took,
+        and count it for the current request. Return None if it
+        wasn't timed.
+        """
+        start = getattr(context, '_query_profiler_start', None)
+        if start is None:
+            return None
+        context._query_profiler_start = None
+        elapsed = time.time() - start
+
+        # statements run outside of a request, by background
+        # threads for example, are timed but not counted
+        if getattr(self.local, 'count', None) is not None:
+            self.local.count += 1
+            self.local.elapsed += elapsed
+        return elapsed
+
+    def _explain(self, cursor, statement, parameters):
+        """
+        Return the plan of a statement, or None if it can't be
+        explained. Runs inside a savepoint so that a failing EXPLAIN
+        doesn't abort the transaction the statement ran in.
+        """
+        keyword = statement.lstrip().split(None, 1)[0].upper()
+        if keyword == 'SELECT':
+            explain = "EXPLAIN ANALYZE "
+        elif keyword in ('INSERT', 'UPDATE', 'DELETE'):
+            explain = "EXPLAIN "
+        else:
+            return None
+
+        explain_cursor = cursor.connection.cursor()
+        try:
+            explain_cursor.execute("SAVEPOINT query_profiler_explain")
+            try:
+                explain_cursor.execute(explain + statement, parameters)
+                plan = "\n".join(row[0] for row in explain_cursor.fetchall())
+                explain_cursor.execute("RELEASE SAVEPOINT query_profiler_explain")
+            except Exception as error:
+                explain_cursor.execute("ROLLBACK TO SAVEPOINT query_profiler_explain")
+                plan = "could not explain: %s" % error
+        except Exception as error:
+            # no transaction to make a savepoint in
+            plan = "could not explain: %s" % error
+        finally:
+            explain_cursor.close()
+        return plan
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import OrderedDict
+
+
+class RsvpCounter():
+    """
+    Aggregates RSVPs in memory and writes them out in batches.
+
+    Every RSVP for a popular event would otherwise be an update of the
+    same row and queue up behind that row's lock. Here RSVPs only bump
+    an in-memory count. flush() hands the accumulated increments to the
+    database in one go, one statement per event per flush, and start()
+    runs a timer thread that calls it every flush_interval seconds.
+
+    Totals for reads come from a cached database count plus the
+    increments that have not been written yet. At most cache_size
+    counts are cached.
+    """
+
+    def __init__(self, flush_interval=1.0, cache_ttl=5.0, cache_size=10000):
+        self.flush_interval = flush_interval
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        # link -> RSVPs not yet written to the database
+        self.pending = {}
+        # link -> RSVPs being written by the current flush
+        self.flushing = {}
+        # link -> (count in the database, time it was read),
+        # oldest read first
+        self.cache = OrderedDict()
+        # number of completed flushes, see total()
+        self.generation = 0
+        self.stopped = threading.Event()
+
+    def add(self, link, count=1):
+        """ Record count RSVPs for the event with this link. """
+        with self.lock:
+            self.pending[link] = self.pending.get(link, 0) + count
+
+    def flush(self, write):
+        """
+        Hand the pending RSVPs to write, a function that takes a
+        dictionary of link -> count and stores it. If write raises,
+        the RSVPs are put back so they go out with the next flush.
+        """
+        with self.lock:
+            batch, self.pending = self.pending, {}
+            self.flushing = batch
+        if not batch:
+            return batch
+
+        try:
+            write(batch)
+        except Exception:
+            with self.lock:
+                self.flushing = {}
+                for link, count in batch.items():
+                    self.pending[link] = self.pending.get(link, 0) + count
+            raise
+
+        with self.lock:
+            self.flushing = {}
+            self.generation += 1
+            # cached counts of the links just written are out of date
+            for link in batch:
+                self.cache.pop(link, None)
+        return batch
+
+    def _evict(self, now):
+        """
+        Drop cached counts that have expired, and the oldest ones
+        beyond cache_size. Call with the lock held.
+        """
+        # counts are kept in the order they were read, so the
+        # expired ones are all at the front
+        while self.cache:
+            link, (_, read_at) = next(iter(self.cache.items()))
+            if now - read_at <= self.cache_ttl and len(self.cache) <= self.cache_size:
+                break
+            del self.cache[link]
+
+    def total(self, link, read):
+        """
+        Return the number of RSVPs for the event with this link.
+        read is a function that returns the count stored in the
+        database, it is only called when the cached count is stale.
+        """
+        now = time.time()
+        with self.lock:
+            self._evict(now)
+            cached = self.cache.get(link)
+            generation = self.generation
+        if cached is None or now - cached[1] > self.cache_ttl:
+            cached = (read(link), time.time())
+            with self.lock:
+                # a flush that finished while we were reading may or
+                # may not be in the count, so don't keep it around
+                if generation == self.generation:
+                    self.cache.pop(link, None)
+                    self.cache[link] = cached
+                    self._evict(cached[1])
+
+        with self.lock:
+            return cached[0] + self.flushing.get(link, 0) + self.pending.get(link, 0)
+
+    def run(self, flush, on_error=None):
+        """
+        Call flush every flush_interval seconds until stop() is called.
+        flush should write the pending RSVPs. Anything it raises is
+        passed to on_error and the timer carries on.
+        """
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                flush()
+            except Exception as error:
+                if on_error is not None:
+                    on_error(error)
+
+    def start(self, flush, on_error=None):
+        """ Run the flush timer in a daemon thread. """
+        thread = threading.Thread(target=self.run, args=(flush, on_error), daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        """ Stop the flush timer. """
+        self.stopped.set()
@@ -2,13 +2,20 @@
 
 import app
 import datetime
+import json
 import logging
 import mock
+import threading
+import time
 import unittest
 from database import Database, Base
-from models import Event
+from linkfilter import LinkFilter, LinkListener
+from models import Event, EventView, OccurrenceOverride, RsvpCount
+from profiling import QueryProfiler
+from rsvp import RsvpCounter
 from flask import template_rendered, escape
 from contextlib import contextmanager
+from sqlalchemy import exc
 from werkzeug.exceptions import InternalServerError
 
 class TestApp(unittest.TestCase):
@@ -34,6 +41,11 @@ class TestApp(unittest.TestCase):
         app.db.db_session.close_all()
         Base.metadata.drop_all(app.db.engine)
 
+    def search(self, url):
+        """ GET a search url as staff. """
+        with mock.patch('app.STAFF_TOKEN', 'staff token'):
+            return self.client.get(url, headers={'X-Staff-Token': 'staff token'})
+
 
     def test_event_model_initialization_missing_values(self):
         """
@@ -166,6 +178,109 @@ class TestApp(unittest.TestCase):
             template, _ = templates[0]
             self.assertEqual(template.name, "not-found.html")
 
+    def test_get_event_not_in_link_filter(self):
+        """
+        Assert that a GET request for a link that is
+        not in the link filter shows the 404 page
+        without querying the database.
+        """
+        wait_for_link_filter()
+        with mock.patch('app.find_event_view', return_value=None) as mock_find:
+            with captured_templates(app.app) as templates:
+                self.client.get("/event/nonexistent")
+                template, _ = templates[0]
+                self.assertEqual(template.name, "not-found.html")
+            self.assertFalse(mock_find.called)
+
+            # links that might exist are looked up
+            app.link_filter.add("deletedevent")
+            self.client.get("/event/deletedevent")
+            self.assertEqual(mock_find.call_count, 1)
+
+    def test_create_event_adds_link_to_filter(self):
+        """
+        Assert that creating an event adds its link
+        to the link filter.
+        """
+        self.client.post('/create', data=self.proper_post_data)
+        event_obj = Event.query.filter(
+                        Event.name==self.proper_post_data['name']).first()
+        self.assertTrue(app.link_filter.might_contain(event_obj.link))
+
+    def test_link_filter_rebuild_fails_mid_scan(self):
+        """
+        Assert that a rebuild that fails part way through
+        the scan is logged and reported, and doesn't stop
+        the next rebuild.
+        """
+        self.client.post('/create', data=self.proper_post_data)
+        wait_for_link_filter()
+        lost = exc.OperationalError("SELECT", {}, Exception("connection lost"))
+        with mock.patch('linkfilter.LinkFilter.add', side_effect=lost):
+            self.assertFalse(app.rebuild_link_filter(wait=True))
+        self.assertFalse(app.link_filter._rebuild_lock.locked())
+        self.assertTrue(app.rebuild_link_filter(wait=True))
+
+    def test_link_might_exist_fails_open(self):
+        """
+        Assert that a link is looked up in the database when
+        the listener's connection fails on a filter miss.
+        """
+        wait_for_link_filter()
+        lost = exc.OperationalError("poll", {}, Exception("connection lost"))
+        with mock.patch.object(app.link_listener, 'poll', side_effect=lost):
+            self.assertTrue(app.link_might_exist("nonexistent"))
+        self.assertFalse(app.link_filter.ready)
+        wait_for_link_filter()
+
+    def test_link_listener(self):
+        """
+        Assert that links of events created by another
+        process reach the link filter through the listener.
+        """
+        link_filter = LinkFilter(capacity=100)
+        link_filter.rebuild(iter([]))
+        listener = LinkListener(app.db.engine, link_filter, on_connect=None)
+        listener.connect()
+        try:
+            # insert without going through create_event,
+            # as another process would
+            event = Event(name="Elsewhere", datetime=datetime.datetime(2017, 12, 12),
+                          tz_offset=0, access="not None")
+            app.db.db_session.add(event)
+            app.db.db_session.commit()
+            link = event.link
+
+            for i in range(50):
+                listener.poll()
+                if link_filter.might_contain(link):
+                    break
+                time.sleep(0.01)
+            self.assertTrue(link_filter.might_contain(link))
+        finally:
+            listener.close()
+
+    def test_find_event_view(self):
+        """
+        Assert that the view page's read path returns only
+        the columns it shows, and None for unknown links.
+        """
+        self.client.post('/create', data=self.proper_post_data)
+        link = Event.query.filter(
+                   Event.name==self.proper_post_data['name']).first().link
+
+        with app.app.test_request_context():
+            event = app.find_event_view(link)
+            self.assertIsInstance(event, EventView)
+            self.assertEqual(event.name, self.proper_post_data['name'])
+            self.assertEqual(event.description, self.proper_post_data['description'])
+            self.assertEqual(event.datetime, datetime.datetime(2017, 12, 12, 10, 0))
+            self.assertEqual(event.tz_offset, -5)
+            self.assertEqual(event.link, link)
+            self.assertFalse(hasattr(event, 'access'))
+
+            self.assertIsNone(app.find_event_view('nonexistent'))
+
     def test_update_event(self):
         """
         Assert that we can successfuly update an event
@@ -353,6 +468,391 @@ class TestApp(unittest.TestCase):
             self.assertEqual(data['name'], escape(self.proper_post_data['name']))
             self.assertEqual(data['description'], escape(self.proper_post_data['description']))
 
+    def test_search_events(self):
+        """
+        Assert that searching for a word in an event's
+        name or description returns that event.
+        """
+        self.client.post('/create', data=self.proper_post_data)
+        link = Event.query.filter(
+                   Event.name==self.proper_post_data['name']).first().link
+
+        response = self.search('/search?q=wonderful')
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.get_data(as_text=True))['results']
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['link'], link)
+
+        response = self.search('/search?q=world')
+        results = json.loads(response.get_data(as_text=True))['results']
+        self.assertEqual(len(results), 1)
+
+        response = self.search('/search?q=nothing')
+        results = json.loads(response.get_data(as_text=True))['results']
+        self.assertEqual(len(results), 0)
+
+        # the search document follows updates to the event
+        data = self.proper_post_data
+        data['name'] = "Renamed Gathering"
+        self.client.put('/event/%s' % link, data=data)
+        response = self.search('/search?q=gathering')
+        results = json.loads(response.get_data(as_text=True))['results']
+        self.assertEqual(len(results), 1)
+
+    def test_search_events_pagination(self):
+        """
+        Assert that following the keyset cursor returns
+        every matching event exactly once.
+        """
+        for i in range(5):
+            self.client.post('/create', data=self.proper_post_data)
+
+        seen = []
+        url = '/search?q=wonderful&limit=2'
+        while url is not None:
+            response = self.search(url)
+            self.assertEqual(response.status_code, 200)
+            body = json.loads(response.get_data(as_text=True))
+            seen.extend(result['link'] for result in body['results'])
+            url = None
+            if body['next'] is not None:
+                url = '/search?q=wonderful&limit=2&after_rank=%r&after_link=%s' \
+                    % (body['next']['after_rank'], body['next']['after_link'])
+
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(len(set(seen)), 5)
+
+    def test_search_events_ranks_newest_candidates(self):
+        """
+        Assert that when more events match than we are willing to
+        rank, only the most recently created ones are returned.
+        """
+        for i in range(5):
+            self.client.post('/create', data=self.proper_post_data)
+        newest = [event.link for event in
+                  Event.query.order_by(Event.id.desc()).limit(3)]
+
+        with mock.patch('app.SEARCH_CANDIDATES', 3):
+            response = self.search('/search?q=wonderful&limit=2')
+            body = json.loads(response.get_data(as_text=True))
+            seen = [result['link'] for result in body['results']]
+            response = self.search(
+                '/search?q=wonderful&limit=2&after_rank=%r&after_link=%s'
+                % (body['next']['after_rank'], body['next']['after_link']))
+            body = json.loads(response.get_data(as_text=True))
+            seen.extend(result['link'] for result in body['results'])
+
+        self.assertEqual(sorted(seen), sorted(newest))
+        self.assertIsNone(body['next'])
+
+    def test_search_events_rare_term(self):
+        """
+        Assert that an event is found when it is older than
+        the newest events scanned for common terms.
+        """
+        data = self.proper_post_data
+        data['name'] = 'Vintage Gathering'
+        self.client.post('/create', data=data)
+        link = Event.query.filter(Event.name==data['name']).first().link
+        data['name'] = 'Modern Gathering'
+        for i in range(3):
+            self.client.post('/create', data=data)
+
+        with mock.patch('app.SEARCH_SCAN_ROWS', 2):
+            response = self.search('/search?q=vintage')
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.get_data(as_text=True))['results']
+        self.assertEqual([result['link'] for result in results], [link])
+
+    def test_search_events_bad_request(self):
+        """
+        Assert that we return a 400 BAD REQUEST when the
+        search terms are missing or the cursor is malformed.
+        """
+        response = self.search('/search')
+        self.assertEqual(response.status_code, 400)
+
+        response = self.search('/search?q=event&limit=0')
+        self.assertEqual(response.status_code, 400)
+
+        response = self.search('/search?q=event&after_rank=0.1')
+        self.assertEqual(response.status_code, 400)
+
+    def test_search_events_staff_only(self):
+        """
+        Assert that we return a 403 FORBIDDEN without the
+        staff token, and that nobody can search when no
+        token is configured.
+        """
+        self.client.post('/create', data=self.proper_post_data)
+        with mock.patch('app.STAFF_TOKEN', 'staff token'):
+            response = self.client.get('/search?q=wonderful')
+            self.assertEqual(response.status_code, 403)
+            response = self.client.get('/search?q=wonderful',
+                                       headers={'X-Staff-Token': 'guess'})
+            self.assertEqual(response.status_code, 403)
+
+        with mock.patch('app.STAFF_TOKEN', None):
+            response = self.client.get('/search?q=wonderful',
+                                       headers={'X-Staff-Token': ''})
+            self.assertEqual(response.status_code, 403)
+
+    def test_search_events_escapes_results(self):
+        """
+        Assert that names and descriptions are escaped in
+        search results, as they are everywhere else.
+        """
+        data = self.proper_post_data
+        data['name'] = '<b>Wonderful</b>'
+        self.client.post('/create', data=data)
+        response = self.search('/search?q=wonderful')
+        results = json.loads(response.get_data(as_text=True))['results']
+        self.assertEqual(results[0]['name'], escape(data['name']))
+
+    def test_limit_statement_time(self):
+        """
+        Assert that statements are cancelled once the
+        deadline they share has passed.
+        """
+        with app.app.app_context():
+            app.limit_statement_time(time.time() - 1)
+            with self.assertRaises(exc.OperationalError):
+                app.db.db_session.execute("SELECT pg_sleep(0.1)")
+            app.db.db_session.rollback()
+
+    def test_create_recurring_event(self):
+        """
+        Assert that a recurring event is stored once
+        with its recurrence rule.
+        """
+        data = self.proper_post_data
+        data['recurrence'] = 'WEEKLY'
+        data['recurrence_interval'] = '2'
+        data['until_year'] = '2018'; data['until_month'] = '1'; data['until_day'] = '31'
+        response = self.client.post('/create', data=data)
+        self.assertEqual(response.status_code, 302)
+
+        event_obj = Event.query.filter(Event.name==data['name']).first()
+        self.assertEqual(event_obj.recurrence, 'WEEKLY')
+        self.assertEqual(event_obj.recurrence_interval, 2)
+        self.assertEqual(event_obj.recurrence_until, datetime.datetime(2018, 1, 31, 23, 59))
+
+    def test_create_recurring_event_invalid_rule(self):
+        """
+        Assert that we return a 400 BAD REQUEST when the
+        recurrence rule or interval is invalid.
+        """
+        data = self.proper_post_data
+        data['recurrence'] = 'HOURLY'
+        response = self.client.post('/create', data=data)
+        self.assertEqual(response.status_code, 400)
+
+        data['recurrence'] = 'DAILY'; data['recurrence_interval'] = '0'
+        response = self.client.post('/create', data=data)
+        self.assertEqual(response.status_code, 400)
+
+    def test_list_occurrences(self):
+        """
+        Assert that the occurrences of a recurring event
+        in the requested window are generated, and that
+        overridden and cancelled occurrences are applied.
+        """
+        data = self.proper_post_data
+        data['recurrence'] = 'WEEKLY'
+        self.client.post('/create', data=data)
+        event_obj = Event.query.filter(Event.name==data['name']).first()
+
+        response = self.client.get('/event/%s/occurrences?start=2018-01-01&end=2018-02-01'
+                                   % event_obj.link)
+        self.assertEqual(response.status_code, 200)
+        occurrences = json.loads(response.get_data(as_text=True))['occurrences']
+        self.assertEqual([o['occurrence'] for o in occurrences],
+                         ['2018-01-02T10:00', '2018-01-09T10:00',
+                          '2018-01-16T10:00', '2018-01-23T10:00',
+                          '2018-01-30T10:00'])
+        self.assertEqual(occurrences[0]['datetime']['timezone'], data['timezone'])
+
+        # cancel one occurrence and rename another
+        response = self.client.delete('/event/%s/occurrences/2018-01-09T10:00' % event_obj.link,
+                                      data={'access': data['access']})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.put('/event/%s/occurrences/2018-01-16T10:00' % event_obj.link,
+                                   data={'access': data['access'], 'name': 'Special Edition'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(OccurrenceOverride.query.count(), 2)
+
+        response = self.client.get('/event/%s/occurrences?start=2018-01-01&end=2018-02-01'
+                                   % event_obj.link)
+        occurrences = json.loads(response.get_data(as_text=True))['occurrences']
+        self.assertEqual(len(occurrences), 4)
+        self.assertNotIn('2018-01-09T10:00', [o['occurrence'] for o in occurrences])
+        self.assertEqual(occurrences[1]['name'], 'Special Edition')
+        self.assertTrue(occurrences[1]['overridden'])
+
+    def test_move_recurring_event_moves_overrides(self):
+        """
+        Assert that changing the start of a recurring event
+        moves its overrides along with the occurrences they
+        apply to.
+        """
+        data = self.proper_post_data
+        data['recurrence'] = 'WEEKLY'
+        self.client.post('/create', data=data)
+        link = Event.query.filter(Event.name==data['name']).first().link
+        self.client.delete('/event/%s/occurrences/2018-01-09T10:00' % link,
+                           data={'access': data['access']})
+        self.client.put('/event/%s/occurrences/2018-01-16T10:00' % link,
+                        data={'access': data['access'], 'name': 'Special Edition'})
+
+        # a week later, the cancelled occurrence moves onto
+        # the start the renamed one had before
+        data['day'] = '19'
+        response = self.client.put('/event/%s' % link, data=data)
+        self.assertEqual(response.status_code, 302)
+
+        response = self.client.get('/event/%s/occurrences?start=2018-01-01&end=2018-02-01'
+                                   % link)
+        occurrences = json.loads(response.get_data(as_text=True))['occurrences']
+        self.assertEqual([o['occurrence'] for o in occurrences],
+                         ['2018-01-02T10:00', '2018-01-09T10:00',
+                          '2018-01-23T10:00', '2018-01-30T10:00'])
+        self.assertEqual(occurrences[2]['name'], 'Special Edition')
+        self.assertEqual(OccurrenceOverride.query.count(), 2)
+
+        # moving off the series grid keeps every override
+        # on an occurrence that exists
+        data['hour'] = '11'
+        self.client.put('/event/%s' % link, data=data)
+        event_obj = Event.query.filter(Event.link==link).first()
+        for override in OccurrenceOverride.query.all():
+            self.assertTrue(event_obj.is_occurrence(override.occurrence))
+
+    def test_override_occurrence_not_in_series(self):
+        """
+        Assert that we show the 404 page when overriding
+        an occurrence that is not part of the series, and
+        return 403 when the access code is wrong.
+        """
+        data = self.proper_post_data
+        data['recurrence'] = 'DAILY'
+        self.client.post('/create', data=data)
+        event_obj = Event.query.filter(Event.name==data['name']).first()
+
+        with captured_templates(app.app) as templates:
+            self.client.delete('/event/%s/occurrences/2018-01-09T11:00' % event_obj.link,
+                               data={'access': data['access']})
+            template, _ = templates[0]
+            self.assertEqual(template.name, "not-found.html")
+
+        response = self.client.delete('/event/%s/occurrences/2018-01-09T10:00' % event_obj.link,
+                                      data={'access': 'WRONG CODE'})
+        self.assertEqual(response.status_code, 403)
+
+    def test_rsvp_event(self):
+        """
+        Assert that RSVPs are written to the database on
+        flush and that the view page shows the total.
+        """
+        self.client.post('/create', data=self.proper_post_data)
+        link = Event.query.filter(
+                   Event.name==self.proper_post_data['name']).first().link
+
+        for i in range(3):
+            response = self.client.post('/event/%s/rsvp' % link)
+            self.assertEqual(response.status_code, 302)
+
+        # counted whether or not the timer has flushed them yet
+        with captured_templates(app.app) as templates:
+            self.client.get('/event/%s' % link)
+            _, context = templates[0]
+            self.assertEqual(context['data']['rsvps'], 3)
+
+        # waits for a flush the timer is in the middle of
+        app.flush_rsvps(wait=True)
+        self.assertEqual(RsvpCount.query.filter(RsvpCount.link==link).first().count, 3)
+
+        # and still counted once after
+        with captured_templates(app.app) as templates:
+            self.client.get('/event/%s' % link)
+            _, context = templates[0]
+            self.assertEqual(context['data']['rsvps'], 3)
+
+    def test_rsvp_event_not_found(self):
+        """
+        Assert that we show the 404 page when a user
+        RSVPs to an event that does not exist.
+        """
+        with captured_templates(app.app) as templates:
+            self.client.post("/event/nonexistent/rsvp")
+            template, _ = templates[0]
+            self.assertEqual(template.name, "not-found.html")
+
+    def test_query_profiling(self):
+        """
+        Assert that with profiling on, responses report the
+        number of queries issued and slow queries are logged
+        with their plan.
+        """
+        self.client.post('/create', data=self.proper_post_data)
+        link = Event.query.filter(
+                   Event.name==self.proper_post_data['name']).first().link
+
+        # background threads share the engine, only count what
+        # is logged while handling the request in this thread
+        messages = []
+        def warning(message):
+            if threading.get_ident() == request_thread:
+                messages.append(message)
+        request_thread = threading.get_ident()
+        logger = mock.Mock()
+        logger.warning.side_effect = warning
+        profiler = QueryProfiler(slow_threshold=0, logger=logger)
+        profiler.install(app.db.engine)
+        try:
+            with mock.patch('app.query_profiler', profiler):
+                response = self.client.get('/event/%s' % link)
+        finally:
+            profiler.uninstall(app.db.engine)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertGreaterEqual(int(response.headers['X-Query-Count']), 1)
+        self.assertIn('X-Query-Time', response.headers)
+        self.assertEqual(len(messages), int(response.headers['X-Query-Count']))
+        self.assertIn('FROM events', messages[0])
+        self.assertIn('actual time', messages[0])
+
+    def test_query_profiling_failed_statement(self):
+        """
+        Assert that a statement cancelled by statement_timeout
+        is counted and logged.
+        """
+        logger = mock.Mock()
+        profiler = QueryProfiler(slow_threshold=0.01, logger=logger)
+        profiler.install(app.db.engine)
+        try:
+            profiler.start_request()
+            with self.assertRaises(exc.OperationalError):
+                app.db.db_session.execute("SET LOCAL statement_timeout = 20")
+                app.db.db_session.execute("SELECT pg_sleep(1)")
+            app.db.db_session.rollback()
+            count, elapsed = profiler.end_request()
+        finally:
+            profiler.uninstall(app.db.engine)
+
+        self.assertEqual(count, 2)
+        self.assertGreater(elapsed, 0.01)
+        messages = [call[0][0] for call in logger.warning.call_args_list]
+        self.assertTrue(any(message.startswith('Failed query') and 'pg_sleep' in message
+                            for message in messages))
+
+    def test_query_profiling_off(self):
+        """
+        Assert that responses don't report query counts
+        when profiling is off.
+        """
+        response = self.client.get('/')
+        self.assertNotIn('X-Query-Count', response.headers)
+
     def test_get_index(self):
         """
         Assert that a GET request to /
@@ -410,6 +910,326 @@ class TestApp(unittest.TestCase):
             self.assertEqual(template.name, "create.html")
 
 
+class TestEventOccurrences(unittest.TestCase):
+
+    def setUp(self):
+        self.event = Event(name="not None", datetime=datetime.datetime(2017, 12, 12, 10, 0),
+                           tz_offset=-5, description="not None", access="not None",
+                           recurrence='DAILY', recurrence_interval=3)
+
+    def test_invalid_recurrence(self):
+        """
+        Assert that the Event model raises ValueError
+        for unknown recurrence rules and intervals.
+        """
+        with self.assertRaises(ValueError):
+            Event(name="not None", datetime="not None", tz_offset=0, recurrence='HOURLY')
+
+        with self.assertRaises(ValueError):
+            Event(name="not None", datetime="not None", tz_offset=0,
+                  recurrence='DAILY', recurrence_interval=0)
+
+    def test_occurrences_start_in_window(self):
+        """
+        Assert that the first occurrence generated is the
+        first one in the window, not the start of the series.
+        """
+        occurrences = self.event.occurrences(datetime.datetime(2027, 1, 1),
+                                             datetime.datetime(2027, 1, 10))
+        starts = [start for start, _ in occurrences]
+        self.assertEqual(starts[0], datetime.datetime(2027, 1, 3, 10, 0))
+        self.assertEqual(len(starts), 3)
+
+    def test_occurrences_until(self):
+        """
+        Assert that no occurrences are generated after
+        the end of the series.
+        """
+        self.event.recurrence_until = datetime.datetime(2017, 12, 18, 23, 59)
+        starts = [start for start, _ in self.event.occurrences(
+                    datetime.datetime(2017, 1, 1), datetime.datetime(2019, 1, 1))]
+        self.assertEqual(starts, [datetime.datetime(2017, 12, 12, 10, 0),
+                                  datetime.datetime(2017, 12, 15, 10, 0),
+                                  datetime.datetime(2017, 12, 18, 10, 0)])
+
+    def test_single_event_occurrence(self):
+        """
+        Assert that an event without a recurrence rule
+        occurs once.
+        """
+        self.event.recurrence = None
+        starts = [start for start, _ in self.event.occurrences(
+                    datetime.datetime(2017, 1, 1), datetime.datetime(2019, 1, 1))]
+        self.assertEqual(starts, [datetime.datetime(2017, 12, 12, 10, 0)])
+        self.assertTrue(self.event.is_occurrence(datetime.datetime(2017, 12, 12, 10, 0)))
+        self.assertFalse(self.event.is_occurrence(datetime.datetime(2017, 12, 13, 10, 0)))
+
+    def test_cancelled_occurrences_skipped(self):
+        """
+        Assert that cancelled occurrences are not generated
+        and overridden ones come with their override.
+        """
+        cancelled = OccurrenceOverride(event_id=1, occurrence=datetime.datetime(2017, 12, 15, 10, 0))
+        cancelled.cancelled = True
+        renamed = OccurrenceOverride(event_id=1, occurrence=datetime.datetime(2017, 12, 18, 10, 0))
+        renamed.name = "Renamed"
+        overrides = {cancelled.occurrence: cancelled, renamed.occurrence: renamed}
+
+        occurrences = list(self.event.occurrences(datetime.datetime(2017, 12, 12),
+                                                  datetime.datetime(2017, 12, 19),
+                                                  overrides))
+        self.assertEqual(occurrences, [(datetime.datetime(2017, 12, 12, 10, 0), None),
+                                       (datetime.datetime(2017, 12, 18, 10, 0), renamed)])
+
+
+class TestRsvpCounter(unittest.TestCase):
+
+    def test_total_includes_pending(self):
+        """
+        Assert that the total is the stored count plus
+        the RSVPs that have not been flushed yet.
+        """
+        counter = RsvpCounter()
+        counter.add('abcdef')
+        counter.add('abcdef')
+        self.assertEqual(counter.total('abcdef', lambda link: 10), 12)
+
+    def test_total_is_cached(self):
+        """
+        Assert that the stored count is only read again
+        once the cached count is stale.
+        """
+        counter = RsvpCounter(cache_ttl=60)
+        read = mock.Mock(return_value=5)
+        counter.total('abcdef', read)
+        counter.total('abcdef', read)
+        self.assertEqual(read.call_count, 1)
+
+    def test_flush(self):
+        """
+        Assert that flush writes the pending RSVPs in one
+        batch, that they are counted while being written, and
+        that cached totals are read again afterwards.
+        """
+        counter = RsvpCounter(cache_ttl=60)
+        counter.total('abcdef', lambda link: 5)
+        counter.add('abcdef', 3)
+        counter.add('123456')
+
+        def write(batch):
+            self.assertEqual(batch, {'abcdef': 3, '123456': 1})
+            self.assertEqual(counter.total('abcdef', lambda link: 5), 8)
+        counter.flush(write)
+        self.assertEqual(counter.pending, {})
+        self.assertEqual(counter.total('abcdef', lambda link: 8), 8)
+
+    def test_failed_flush_keeps_rsvps(self):
+        """
+        Assert that RSVPs are not lost when writing
+        them to the database fails.
+        """
+        counter = RsvpCounter()
+        counter.add('abcdef', 3)
+        write = mock.Mock(side_effect=RuntimeError)
+        with self.assertRaises(RuntimeError):
+            counter.flush(write)
+        counter.add('abcdef')
+        self.assertEqual(counter.pending, {'abcdef': 4})
+
+    def test_cache_is_bounded(self):
+        """
+        Assert that reading totals evicts expired counts
+        and keeps at most cache_size of them.
+        """
+        counter = RsvpCounter(cache_ttl=60, cache_size=3)
+        for i in range(5):
+            counter.total('%06x' % i, lambda link: 0)
+        self.assertEqual(list(counter.cache), ['000002', '000003', '000004'])
+
+        counter.cache_ttl = 0
+        time.sleep(0.01)
+        counter.total('abcdef', lambda link: 0)
+        self.assertEqual(list(counter.cache), ['abcdef'])
+
+    def test_flush_timer(self):
+        """
+        Assert that the timer started with start() flushes
+        every flush_interval seconds until it is stopped.
+        """
+        counter = RsvpCounter(flush_interval=0.01)
+        flush = mock.Mock()
+        thread = counter.start(flush)
+        time.sleep(0.1)
+        counter.stop()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertGreater(flush.call_count, 1)
+
+    def test_flush_timer_survives_errors(self):
+        """
+        Assert that the timer keeps flushing after a flush
+        raises, and reports the error.
+        """
+        counter = RsvpCounter(flush_interval=0.01)
+        flush = mock.Mock(side_effect=RuntimeError)
+        on_error = mock.Mock()
+        thread = counter.start(flush, on_error)
+        time.sleep(0.1)
+        counter.stop()
+        thread.join(1)
+        self.assertGreater(flush.call_count, 1)
+        self.assertEqual(on_error.call_count, flush.call_count)
+
+
+class TestLinkFilter(unittest.TestCase):
+
+    def test_added_links_are_found(self):
+        """
+        Assert that every link added to the filter
+        is reported as possibly present.
+        """
+        link_filter = LinkFilter(capacity=1000)
+        links = ['%06x' % i for i in range(1000)]
+        for link in links:
+            link_filter.add(link)
+        for link in links:
+            self.assertTrue(link_filter.might_contain(link))
+
+    def test_false_positive_rate_within_bounds(self):
+        """
+        Assert that the observed and expected false positive
+        rates stay close to the configured error rate when the
+        filter is filled to capacity.
+        """
+        link_filter = LinkFilter(capacity=10000, error_rate=0.01)
+        link_filter.rebuild(iter([]))
+        for i in range(10000):
+            link_filter.add('%06x' % i)
+
+        false_positives = sum(1 for i in range(10000, 20000)
+                              if link_filter.might_contain('%06x' % i))
+        self.assertLess(false_positives / 10000, 0.02)
+        self.assertLess(link_filter.false_positive_rate(), 0.02)
+
+    def test_rebuild_drops_removed_links(self):
+        """
+        Assert that rebuilding the filter forgets links
+        that are no longer present.
+        """
+        link_filter = LinkFilter(capacity=100)
+        link_filter.add('abcdef')
+        link_filter.rebuild(iter(['123456']), expected_count=1)
+        self.assertTrue(link_filter.might_contain('123456'))
+        self.assertFalse(link_filter.might_contain('abcdef'))
+        self.assertEqual(link_filter.count, 1)
+
+    def test_adding_link_twice_counts_once(self):
+        """
+        Assert that a link added twice, e.g. by create_event
+        and by the listener, is counted once.
+        """
+        link_filter = LinkFilter(capacity=100)
+        link_filter.add('abcdef')
+        link_filter.add('abcdef')
+        self.assertEqual(link_filter.count, 1)
+
+    def test_rebuild_fails_mid_scan(self):
+        """
+        Assert that a rebuild whose links raise part way
+        through is cancelled, and cancelling it again is
+        harmless.
+        """
+        def links():
+            yield 'abcdef'
+            raise RuntimeError("connection lost")
+
+        link_filter = LinkFilter(capacity=100)
+        with self.assertRaises(RuntimeError):
+            link_filter.rebuild(links())
+        link_filter.cancel_rebuild()
+        self.assertFalse(link_filter._rebuild_lock.locked())
+        self.assertFalse(link_filter.ready)
+        link_filter.rebuild(iter(['123456']))
+        self.assertTrue(link_filter.ready)
+
+    def test_stats(self):
+        """
+        Assert that the filter reports its memory use
+        and expected false positive rate.
+        """
+        link_filter = LinkFilter(capacity=1000)
+        link_filter.add('abcdef')
+        stats = link_filter.stats()
+        self.assertEqual(stats['count'], 1)
+        self.assertEqual(stats['memory_bytes'], len(link_filter.bits))
+        self.assertGreater(stats['false_positive_rate'], 0)
+
+    def test_fails_open_until_built(self):
+        """
+        Assert that every link might exist until the
+        filter has been built, and again once it is
+        invalidated.
+        """
+        link_filter = LinkFilter(capacity=100)
+        self.assertTrue(link_filter.might_contain('abcdef'))
+        link_filter.rebuild(iter([]))
+        self.assertFalse(link_filter.might_contain('abcdef'))
+        link_filter.invalidate()
+        self.assertTrue(link_filter.might_contain('abcdef'))
+
+    def test_invalidate_during_rebuild(self):
+        """
+        Assert that a rebuild that began before the filter
+        was invalidated does not make it ready.
+        """
+        link_filter = LinkFilter(capacity=100)
+        link_filter.begin_rebuild()
+        link_filter.invalidate()
+        link_filter.end_rebuild(iter(['123456']))
+        self.assertFalse(link_filter.ready)
+
+    def test_links_added_during_rebuild_are_kept(self):
+        """
+        Assert that links added after begin_rebuild() but
+        missing from the scan end up in the filter.
+        """
+        link_filter = LinkFilter(capacity=100)
+        link_filter.begin_rebuild()
+        link_filter.add('abcdef')
+        link_filter.end_rebuild(iter(['123456']))
+        self.assertTrue(link_filter.ready)
+        self.assertTrue(link_filter.might_contain('abcdef'))
+        self.assertTrue(link_filter.might_contain('123456'))
+
+    def test_failed_rebuild_retried_soon(self):
+        """
+        Assert that a filter that failed to build is stale
+        after retry_interval rather than max_age.
+        """
+        link_filter = LinkFilter(capacity=100, max_age=3600, retry_interval=0.05)
+        self.assertTrue(link_filter.is_stale())
+        link_filter.begin_rebuild()
+        link_filter.cancel_rebuild()
+        self.assertFalse(link_filter.is_stale())
+        time.sleep(0.1)
+        self.assertTrue(link_filter.is_stale())
+        link_filter.rebuild(iter([]))
+        self.assertFalse(link_filter.is_stale())
+
+
+def wait_for_link_filter():
+    """
+    Start the app's link listener and wait for it to connect,
+    then build the link filter so that misses are trusted.
+    """
+    app.start_background_workers()
+    for i in range(500):
+        if app.link_listener.connected:
+            break
+        time.sleep(0.01)
+    app.link_filter.rebuild(iter([]))
+
+
 # we use this to capture the template objects that are created by the views
 @contextmanager
 def captured_templates(app):